@@ -1,34 +1,30 @@
-"""Provides the app package for the Social Insecurity application. The package contains the Flask app and all of the extensions and routes."""
+"""Provides the app package for the Social Insecurity application. The package contains the application factory and
+all of the extensions and routes.
 
-from pathlib import Path
-from functools import wraps
-from typing import cast
-
-from flask import Flask, request
+Importing the package is cheap: the extensions, their dependencies and the routes are only imported once an
+application is created with `create_app`.
 
-from app.config import Config
-from app.database import SQLite3
-
-#from flask_login import LoginManager, UserMixin, login_user
-from flask import redirect, url_for, session, flash
-from flask_bcrypt import Bcrypt
+Example:
+    from app import create_app
 
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+    app = create_app()
+    app.run()
+"""
 
-from flask_wtf.csrf import CSRFProtect
-from flask_bootstrap import Bootstrap
+from __future__ import annotations
 
-# Instantiate and configure the app
-app = Flask(__name__)
-Bootstrap(app)
-app.config.from_object(Config)
+import time
+from collections.abc import Mapping
+from functools import wraps
+from pathlib import Path
+from typing import Any, cast
 
-# Instantiate the sqlite database extension
-sqlite = SQLite3(app, schema="schema.sql")
+import click
+from flask import Flask, current_app, flash, redirect, session, url_for
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
 
-# Rate limit
-limiter = Limiter(get_remote_address, app=app, default_limits=["1000 per day", "500 per hour", "10 per minute"])
+from app.config import Config
 
 # TODO: Handle login management better, maybe with flask_login?
 # login = LoginManager(app)
@@ -42,6 +38,7 @@ limiter = Limiter(get_remote_address, app=app, default_limits=["1000 per day", "
 # def load_user(user_id):
 #     return User.query.get(int(id))
 
+
 #if anyone tryes to access non-accessible page, send them to index
 def login_required(func): #
     @wraps(func)
@@ -52,22 +49,99 @@ def login_required(func): #
         return func(*args, **kwargs)
     return decorated_function
 
-# TODO: The passwords are stored in plaintext, this is not secure at all. I should probably use bcrypt or something
-bcrypt = Bcrypt(app)
 
-# TODO: The CSRF protection is not working, I should probably fix that
-csrf = CSRFProtect(app)
+def create_app(config: object | Mapping[str, Any] = Config) -> Flask:
+    """Creates and configures an instance of the application.
 
+    params:
+        config (optional): A configuration object, or a mapping of values applied on top of the default `Config`.
 
+    returns: The configured Flask application.
 
-# Create the instance and upload folder if they do not exist
-with app.app_context():
+    """
+    start = time.perf_counter()
+
+    # Instantiate and configure the app
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, Mapping):
+        app.config.update(config)
+    elif config is not Config:
+        app.config.from_object(config)
+
+    # Create the instance and upload folder if they do not exist
     instance_path = Path(app.instance_path)
-    if not instance_path.exists():
-        instance_path.mkdir(parents=True, exist_ok=True)
+    instance_path.mkdir(parents=True, exist_ok=True)
     upload_path = instance_path / cast(str, app.config["UPLOADS_FOLDER_PATH"])
-    if not upload_path.exists():
-        upload_path.mkdir(parents=True, exist_ok=True)
-
-# Import the routes after the app is configured
-from app import routes  # noqa: E402,F401
+    upload_path.mkdir(parents=True, exist_ok=True)
+
+    # Cache compiled templates on disk, keyed on the template source, so that new workers do not recompile them
+    template_cache_path = instance_path / cast(str, app.config["TEMPLATE_CACHE_FOLDER_PATH"])
+    template_cache_path.mkdir(parents=True, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(str(template_cache_path))
+
+    # Import the extensions and routes lazily, so that importing the package does not pull them in
+    from app import routes, sharding
+    from app.extensions import bcrypt, bootstrap, compress, csrf, limiter, sqlite, static_assets, tasks
+
+    bootstrap.init_app(app)
+    sqlite.init_app(app, schema="schema.sql", shard_schema="shard_schema.sql")
+    tasks.init_app(app)
+    limiter.init_app(app)
+    bcrypt.init_app(app)
+    csrf.init_app(app)
+    compress.init_app(app)
+    static_assets.init_app(app)
+    routes.init_app(app)
+    app.cli.add_command(precompile_templates_command)
+    app.cli.add_command(boot_time_command)
+    app.cli.add_command(sharding.rebalance_command)
+
+    # Take periodic snapshots of the database for analytical queries
+    if app.config["SQLITE3_BACKUP_INTERVAL"]:
+        with app.app_context():
+            tasks.schedule(tasks.task(backup_database), app.config["SQLITE3_BACKUP_INTERVAL"])
+
+    # Keep the boot timings on the app, as the Flask logger does not show info messages by default
+    app.extensions["boot_time"] = {"create_app": (time.perf_counter() - start) * 1000}
+    app.logger.info("Application created in %.1f ms", app.extensions["boot_time"]["create_app"])
+    return app
+
+
+def prewarm(app: Flask) -> None:
+    """Prepares the application for serving before worker processes are forked from it.
+
+    Compiles every template into the Jinja environment cache, so that forked workers inherit them instead of
+    compiling them on their first request. The compiled templates are also written to the bytecode cache. No database
+    connection is left open, as SQLite connections must not be shared across a fork.
+
+    params:
+        app: The Flask application to prepare.
+
+    """
+    start = time.perf_counter()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    app.extensions["boot_time"]["prewarm"] = (time.perf_counter() - start) * 1000
+    app.logger.info("Application prewarmed in %.1f ms", app.extensions["boot_time"]["prewarm"])
+
+
+def backup_database() -> None:
+    """Takes an online snapshot of the database."""
+    current_app.extensions["sqlite3"].backup()
+
+
+@click.command("precompile-templates")
+@with_appcontext
+def precompile_templates_command() -> None:
+    """Compiles all templates into the template bytecode cache."""
+    prewarm(current_app)
+    click.echo(f"Precompiled {len(current_app.jinja_env.list_templates())} templates.")
+
+
+@click.command("boot-time")
+@with_appcontext
+def boot_time_command() -> None:
+    """Shows how long creating and prewarming the application took, in milliseconds."""
+    for step, duration in current_app.extensions["boot_time"].items():
+        click.echo(f"{step}: {duration:.1f} ms")
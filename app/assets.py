@@ -0,0 +1,170 @@
+"""Provides a static asset extension for Flask.
+
+This extension builds fingerprinted and precompressed copies of the static files, and serves them with far-future
+cache headers.
+
+Example:
+    from flask import Flask
+    from app.assets import StaticAssets
+
+    app = Flask(__name__)
+    assets = StaticAssets(app)
+
+    # Build the assets with 'flask build-static', then link them as usual
+    # url_for("static", filename="css/general.css")
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import mimetypes
+from pathlib import Path
+from typing import Optional, cast
+
+import click
+from flask import Flask, Response, current_app, request, send_from_directory
+from flask.cli import with_appcontext
+
+from app.compression import COMPRESS_MIMETYPES
+
+
+class _StaticAssetsState:
+    """Holds the static asset manifest of a single application."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.manifest: dict[str, str] = {}
+        self.fingerprinted: set[str] = set()
+
+    def load_manifest(self, manifest: dict[str, str]) -> None:
+        """Loads the manifest mapping static filenames to fingerprinted filenames."""
+        self.manifest = manifest
+        self.fingerprinted = set(manifest.values())
+
+
+class StaticAssets:
+    """Provides a static asset extension for Flask.
+
+    The build step copies every static file to a fingerprinted filename containing a hash of its content, writes a
+    gzip compressed copy next to it if its mimetype is in `COMPRESS_MIMETYPES`, and records the names in a manifest.
+    Once built, `url_for("static", ...)` links to the fingerprinted file, which can be cached by clients for
+    `STATIC_MAX_AGE` seconds. Static files missing from the manifest are served as usual. Each application has its own
+    build folder and manifest.
+
+    Example:
+        from flask import Flask
+        from app.assets import StaticAssets
+
+        app = Flask(__name__)
+        assets = StaticAssets(app)
+        assets.build()
+    """
+
+    def __init__(self, app: Optional[Flask] = None) -> None:
+        """Initializes the extension.
+
+        params:
+            app: The Flask application to initialize the extension with.
+
+        """
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Initializes the extension.
+
+        params:
+            app: The Flask application to initialize the extension with.
+
+        """
+        if "static_assets" not in app.extensions:
+            app.extensions["static_assets"] = self
+        else:
+            raise RuntimeError("Flask StaticAssets extension already initialized")
+
+        app.config.setdefault("STATIC_BUILD_FOLDER_PATH", "static_build")
+        # Fingerprinted static files never change, so clients may cache them for a year
+        app.config.setdefault("STATIC_MAX_AGE", 365 * 24 * 60 * 60)
+        state = app.extensions["static_assets_state"] = _StaticAssetsState(
+            Path(app.instance_path) / app.config["STATIC_BUILD_FOLDER_PATH"]
+        )
+
+        manifest_path = state.path / "manifest.json"
+        if manifest_path.exists():
+            state.load_manifest(json.loads(manifest_path.read_text()))
+
+        app.url_defaults(self._fingerprint_url)
+        if app.has_static_folder:
+            app.view_functions["static"] = self._send_static_file
+        app.cli.add_command(build_static_command)
+
+    def build(self) -> dict[str, str]:
+        """Builds the fingerprinted and precompressed static files.
+
+        Files from earlier builds are kept, so that pages rendered before a deploy can still load their assets.
+
+        returns: The manifest mapping each static filename to its fingerprinted filename.
+
+        """
+        state = self._state
+        mimetypes_to_compress = current_app.config.get("COMPRESS_MIMETYPES", COMPRESS_MIMETYPES)
+        static_path = Path(cast(str, current_app.static_folder))
+        manifest = {}
+        for source in sorted(static_path.rglob("*")):
+            if not source.is_file():
+                continue
+            data = source.read_bytes()
+            filename = Path(source.relative_to(static_path))
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            fingerprinted = filename.with_name(f"{filename.stem}.{digest}{filename.suffix}").as_posix()
+
+            target = state.path / fingerprinted
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(data)
+            if mimetypes.guess_type(fingerprinted)[0] in mimetypes_to_compress:
+                target.with_name(f"{target.name}.gz").write_bytes(gzip.compress(data, compresslevel=9, mtime=0))
+            manifest[filename.as_posix()] = fingerprinted
+
+        (state.path / "manifest.json").write_text(json.dumps(manifest, indent=2, sort_keys=True))
+        state.load_manifest(manifest)
+        return manifest
+
+    @property
+    def _state(self) -> _StaticAssetsState:
+        """Returns the static asset state of the current application."""
+        return cast(_StaticAssetsState, current_app.extensions["static_assets_state"])
+
+    def _fingerprint_url(self, endpoint: str, values: dict) -> None:
+        """Replaces the filename of static URLs with the fingerprinted filename, if one has been built."""
+        manifest = self._state.manifest
+        if endpoint == "static" and values.get("filename") in manifest:
+            values["filename"] = manifest[values["filename"]]
+
+    def _send_static_file(self, filename: str) -> Response:
+        """Serves a static file, preferring the precompressed fingerprinted copy."""
+        state = self._state
+        if filename not in state.fingerprinted:
+            return current_app.send_static_file(filename)
+
+        max_age = current_app.config["STATIC_MAX_AGE"]
+        compressed = state.path / f"{filename}.gz"
+        if request.accept_encodings.quality("gzip") > 0 and compressed.exists():
+            response = send_from_directory(
+                state.path, f"{filename}.gz", mimetype=mimetypes.guess_type(filename)[0], max_age=max_age
+            )
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = send_from_directory(state.path, filename, max_age=max_age)
+        response.vary.add("Accept-Encoding")
+        response.cache_control.immutable = True
+        return response
+
+
+@click.command("build-static")
+@with_appcontext
+def build_static_command() -> None:
+    """Builds fingerprinted and precompressed copies of the static files."""
+    manifest = current_app.extensions["static_assets"].build()
+    click.echo(f"Built {len(manifest)} static files.")
@@ -0,0 +1,88 @@
+"""Provides a response compression extension for Flask.
+
+This extension compresses textual responses with gzip when the client accepts it.
+
+Example:
+    from flask import Flask
+    from app.compression import Compress
+
+    app = Flask(__name__)
+    compress = Compress(app)
+"""
+
+from __future__ import annotations
+
+import gzip
+from typing import Optional
+
+from flask import Flask, Response, current_app, request
+
+# The mimetypes compressed by default, which are also precompressed by the static asset build
+COMPRESS_MIMETYPES = frozenset({"text/html", "text/css", "application/json"})
+
+
+class Compress:
+    """Provides a response compression extension for Flask.
+
+    Responses are only compressed if their mimetype is listed in `COMPRESS_MIMETYPES` and their body is at least
+    `COMPRESS_MIN_SIZE` bytes. Files sent from disk, such as image uploads, are passed through untouched.
+
+    Example:
+        from flask import Flask
+        from app.compression import Compress
+
+        app = Flask(__name__)
+        app.config["COMPRESS_LEVEL"] = 6
+        compress = Compress(app)
+    """
+
+    def __init__(self, app: Optional[Flask] = None) -> None:
+        """Initializes the extension.
+
+        params:
+            app: The Flask application to initialize the extension with.
+
+        """
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Initializes the extension.
+
+        params:
+            app: The Flask application to initialize the extension with.
+
+        """
+        if "compress" not in app.extensions:
+            app.extensions["compress"] = self
+        else:
+            raise RuntimeError("Flask Compress extension already initialized")
+
+        app.config.setdefault("COMPRESS_MIMETYPES", COMPRESS_MIMETYPES)
+        app.config.setdefault("COMPRESS_MIN_SIZE", 500)  # Responses smaller than this are not worth compressing
+        app.config.setdefault("COMPRESS_LEVEL", 6)
+        app.after_request(self._compress_response)
+
+    def _compress_response(self, response: Response) -> Response:
+        """Compresses the response body if the response and the client allow it."""
+        if (
+            response.direct_passthrough
+            or response.is_streamed
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in current_app.config["COMPRESS_MIMETYPES"]
+        ):
+            return response
+
+        response.vary.add("Accept-Encoding")
+        if request.accept_encodings.quality("gzip") <= 0:
+            return response
+
+        data = response.get_data()
+        if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+            return response
+
+        response.set_data(gzip.compress(data, compresslevel=current_app.config["COMPRESS_LEVEL"]))
+        response.headers["Content-Encoding"] = "gzip"
+        return response
@@ -19,7 +19,15 @@ import os
 class Config:
     SECRET_KEY = os.environ.get("SECRET_KEY") or " Group2f91349b2d25fab62228eb7feaaa9dba9f4909b74c2f569e2cf37038ff78fc9e"  # TODO: Use this with wtforms
     SQLITE3_DATABASE_PATH = "sqlite3.db"  # Path relative to the Flask instance folder
+    SQLITE3_SHARDS = 1  # Number of database files posts and comments are split across, rebalance after changing it
+    SQLITE3_SNAPSHOT_PATH = "snapshot.db"  # Path relative to the Flask instance folder
+    SQLITE3_BACKUP_INTERVAL = 60 * 60  # Seconds between database snapshots, 0 disables them
+    SQLITE3_BACKUP_PAGES = 256  # Pages copied per backup step, pausing after each step to limit the I/O of backups
     UPLOADS_FOLDER_PATH = "uploads"  # Path relative to the Flask instance folder
+    TASKS_DATABASE_PATH = "tasks.db"  # Path relative to the Flask instance folder
+    TASKS_WORKERS = 2  # Number of background task worker threads per process
+    TEMPLATE_CACHE_FOLDER_PATH = "template_cache"  # Path relative to the Flask instance folder
+    STATIC_BUILD_FOLDER_PATH = "static_build"  # Path relative to the Flask instance folder
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}  # TODO: Might use this at some point, probably don't want people to upload any file type
     WTF_CSRF_ENABLED = False  # TODO: I should probably implement this wtforms feature, but it's not a priority
     
@@ -12,12 +12,41 @@ Example:
 
 from __future__ import annotations
 
+import heapq
+import os
 import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain
 from os import PathLike
 from pathlib import Path
-from typing import Any, Optional, cast
+from typing import Any, Callable, Optional, cast
 
+import click
 from flask import Flask, current_app, g
+from flask.cli import with_appcontext
+
+# Each shard allocates ids from its own range, so ids stay unique when rows are moved between shards
+SHARD_ID_RANGE = 2**48
+
+SHARD_DIRECTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS [ShardDirectory] (
+  key INTEGER PRIMARY KEY,
+  shard INTEGER NOT NULL
+);
+"""
+
+SHARD_SEQUENCES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS [ShardSequences] (
+  name VARCHAR PRIMARY KEY,
+  value INTEGER NOT NULL
+);
+"""
 
 
 class SQLite3:
@@ -37,6 +66,15 @@ class SQLite3:
         # db.query("SELECT * FROM Users;")
         # db.query("SELECT * FROM Users WHERE id = 1;", one=True)
         # db.query("INSERT INTO Users (name, email) VALUES ('John', 'test@test.net');")
+
+        # Take a snapshot, and run analytical queries against it
+        # db.backup()
+        # db.query_snapshot("SELECT COUNT(*) FROM Users;", one=True)
+        # db.query_snapshots("SELECT COUNT(*) FROM Posts;")
+
+        # Split tables across several database files, and query all of them
+        # db.query_shard(db.shard_for(1), "INSERT INTO Posts (id, u_id) VALUES (?, 1);", args=(post_id,))
+        # db.query_shards("SELECT * FROM Posts ORDER BY id;", key=lambda row: row["id"])
     """
 
     def __init__(
@@ -45,6 +83,7 @@ class SQLite3:
         *,
         path: Optional[PathLike | str] = None,
         schema: Optional[PathLike | str] = None,
+        shard_schema: Optional[PathLike | str] = None,
     ) -> None:
         """Initializes the extension.
 
@@ -52,10 +91,12 @@ class SQLite3:
             app: The Flask application to initialize the extension with.
             path (optional): The path to the database file. Is relative to the instance folder.
             schema (optional): The path to the schema file. Is relative to the application root folder.
+            shard_schema (optional): The path to the schema file for the additional shards. Is relative to the
+                application root folder.
 
         """
         if app is not None:
-            self.init_app(app, path=path, schema=schema)
+            self.init_app(app, path=path, schema=schema, shard_schema=shard_schema)
 
     def init_app(
         self,
@@ -63,6 +104,7 @@ class SQLite3:
         *,
         path: Optional[PathLike | str] = None,
         schema: Optional[PathLike | str] = None,
+        shard_schema: Optional[PathLike | str] = None,
     ) -> None:
         """Initializes the extension.
 
@@ -70,6 +112,8 @@ class SQLite3:
             app: The Flask application to initialize the extension with.
             path (optional): The path to the database file. Is relative to the instance folder.
             schema (optional): The path to the schema file. Is relative to the application root folder.
+            shard_schema (optional): The path to the schema file for the additional shards. Is relative to the
+                application root folder.
 
         """
         if not hasattr(app, "extensions"):
@@ -84,26 +128,63 @@ class SQLite3:
             raise ValueError("Cannot use in-memory database with Flask SQLite3 extension")
 
         if path:
-            self._path = Path(app.instance_path) / path
+            database_path = Path(app.instance_path) / path
         elif "SQLITE3_DATABASE_PATH" in app.config:
-            self._path = Path(app.instance_path) / app.config["SQLITE3_DATABASE_PATH"]
+            database_path = Path(app.instance_path) / app.config["SQLITE3_DATABASE_PATH"]
         else:
-            self._path = Path(app.instance_path) / "sqlite3.db"
+            database_path = Path(app.instance_path) / "sqlite3.db"
+
+        if not database_path.exists():
+            database_path.parent.mkdir(parents=True, exist_ok=True)
 
-        if not self._path.exists():
-            self._path.parent.mkdir(parents=True, exist_ok=True)
+        app.config.setdefault("SQLITE3_SHARDS", 1)
+        if app.config["SQLITE3_SHARDS"] > 1 and not shard_schema:
+            raise ValueError("Cannot use more than one shard without a shard schema")
 
+        app.config.setdefault("SQLITE3_SNAPSHOT_PATH", "snapshot.db")
+        app.config.setdefault("SQLITE3_SNAPSHOT_POOL_SIZE", 4)
+        app.config.setdefault("SQLITE3_BACKUP_PAGES", 256)
+        app.config.setdefault("SQLITE3_BACKUP_SLEEP", 0.05)
+
+        # The extension may be shared by several applications, so their state is kept with each application
+        app.extensions["sqlite3_state"] = _SQLite3State(
+            path=database_path,
+            shard_count=app.config["SQLITE3_SHARDS"],
+            snapshot_path=Path(app.instance_path) / app.config["SQLITE3_SNAPSHOT_PATH"],
+            snapshot_pool_size=app.config["SQLITE3_SNAPSHOT_POOL_SIZE"],
+        )
+
+        # Registered first, so that the connections opened to initialize the database are closed before a fork
+        app.teardown_appcontext(self._close_connection)
         if schema:
             with app.app_context():
                 self._init_database(schema)
-        app.teardown_appcontext(self._close_connection)
+        with app.app_context():
+            self._init_shards(shard_schema)
+        app.cli.add_command(backup_command)
+
+    @property
+    def shard_count(self) -> int:
+        """Returns the number of shards of the database of the current application."""
+        return self._state.shard_count
 
     @property
     def connection(self) -> sqlite3.Connection:
         """Returns the connection to the SQLite3 database."""
         conn = getattr(g, "flask_sqlite3_connection", None) ##thread safety
         if conn is None:
-            conn = g.flask_sqlite3_connection = sqlite3.connect(self._path)
+            conn = g.flask_sqlite3_connection = sqlite3.connect(self._state.path)
+            conn.row_factory = sqlite3.Row
+        return conn
+
+    def shard_connection(self, shard: int) -> sqlite3.Connection:
+        """Returns the connection to a shard of the SQLite3 database. The first shard is the database itself."""
+        if shard == 0:
+            return self.connection
+        connections = g.setdefault("flask_sqlite3_shard_connections", {})
+        conn = connections.get(shard)
+        if conn is None:
+            conn = connections[shard] = sqlite3.connect(_shard_path(self._state.path, shard))
             conn.row_factory = sqlite3.Row
         return conn
 
@@ -117,34 +198,412 @@ class SQLite3:
 
         returns: A single row, a list of rows or None.
 
+        """
+        return self.query_shard(0, query, one=one, args=args)
+
+    def query_shard(self, shard: int, query: str, one: bool = False, args: tuple = ()) -> Any:
+        """Queries a shard of the database and returns the result.
+
+        params:
+            shard: The index of the shard to query.
+            query: The SQL query to execute.
+            one: Whether to return a single row or a list of rows.
+            args: Additional arguments to pass to the query.
+
+        returns: A single row, a list of rows or None.
+
         """ ##adding error handling
-        cursor = self.connection.cursor()
+        conn = self.shard_connection(shard)
+        cursor = conn.cursor()
         try:
             cursor.execute(query, args)
             response = cursor.fetchone() if one else cursor.fetchall()
-            self.connection.commit()
+            conn.commit()
             return response
         except sqlite3.Error as e: 
             print(F"Error: {e}")
             return None
         finally:
             cursor.close()
-        
+
+    def query_each_shard(self, query: str, one: bool = False, args: tuple = ()) -> list[Any]:
+        """Queries every shard of the database in parallel and returns the result of each shard.
+
+        params:
+            query: The read-only SQL query to execute.
+            one: Whether to return a single row or a list of rows from each shard.
+            args: Additional arguments to pass to the query.
+
+        returns: A single row, a list of rows or None for each shard, in shard order.
+
+        """
+        state = self._state
+        if state.shard_count == 1:
+            return [self.query(query, one=one, args=args)]
+        shards = range(state.shard_count)
+        return list(_executor(state).map(lambda shard: _query_in_thread(state, shard, query, one, args), shards))
+
+    def query_shards(
+        self, query: str, args: tuple = (), *, key: Optional[Callable[[sqlite3.Row], Any]] = None, reverse: bool = False
+    ) -> list[sqlite3.Row]:
+        """Queries every shard of the database in parallel and returns the combined rows.
+
+        params:
+            query: The read-only SQL query to execute.
+            args: Additional arguments to pass to the query.
+            key (optional): Returns the sort key of a row. The rows of each shard must already be sorted by this key,
+                and are merged in order.
+            reverse: Whether the rows are sorted in descending order.
+
+        returns: A list of rows.
+
+        """
+        results = [rows or [] for rows in self.query_each_shard(query, args=args)]
+        if key is None:
+            return list(chain.from_iterable(results))
+        return list(heapq.merge(*results, key=key, reverse=reverse))
+
+    def shard_for(self, key: int) -> int:
+        """Returns the shard a key is stored in.
+
+        Keys are spread across the shards by their value, unless they have been assigned to a shard with `set_shard`.
+        Keys assigned to a shard beyond `SQLITE3_SHARDS` fall back to the default shard, so after the number of shards
+        is reduced, the shards must be rebalanced to move their rows out of the `removed_shards`.
+        """
+        if self.shard_count == 1:
+            return 0
+        row = self.connection.execute("SELECT shard FROM ShardDirectory WHERE key = ?;", (key,)).fetchone()
+        if row is not None and row["shard"] < self.shard_count:
+            return row["shard"]
+        return key % self.shard_count
+
+    def removed_shards(self) -> list[int]:
+        """Returns the shards beyond `SQLITE3_SHARDS` which still have a database file, in order.
+
+        These are left behind when the number of shards is reduced. Their files must be kept once they are empty, as
+        they hold the last ids allocated in their range.
+        """
+        state = self._state
+        prefix, suffix = f"{state.path.stem}.shard", state.path.suffix
+        shards = []
+        for shard_path in state.path.parent.glob(f"{prefix}*{suffix}"):
+            index = shard_path.name[len(prefix) : len(shard_path.name) - len(suffix)]
+            if index.isdigit() and int(index) >= state.shard_count:
+                shards.append(int(index))
+        return sorted(shards)
+
+    def set_shard(self, key: int, shard: int) -> None:
+        """Assigns a key to a shard. Rows already stored for the key are not moved."""
+        if not 0 <= shard < self.shard_count:
+            raise ValueError(f"Shard {shard} does not exist")
+        self.connection.execute("INSERT OR REPLACE INTO ShardDirectory (key, shard) VALUES (?, ?);", (key, shard))
+        self.connection.commit()
+
+    def next_id(self, shard: int, table: str) -> int:
+        """Allocates the next id for a table in a shard, without committing.
+
+        Each shard allocates ids from its own range of `SHARD_ID_RANGE` ids, so ids are unique across all shards and
+        rows keep their id when they are moved to another shard. The first shard continues after its existing ids.
+
+        params:
+            shard: The index of the shard the row is inserted into.
+            table: The name of the table, which must have an integer `id` column.
+
+        returns: The allocated id.
+
+        """
+        conn = self.shard_connection(shard)
+        start = shard * SHARD_ID_RANGE
+        conn.execute(
+            f"""
+            INSERT OR IGNORE INTO ShardSequences (name, value)
+            SELECT ?, COALESCE(MAX(id), ?) FROM [{table}] WHERE id >= ? AND id < ?;
+            """,
+            (table, start, start, start + SHARD_ID_RANGE),
+        )
+        conn.execute("UPDATE ShardSequences SET value = value + 1 WHERE name = ?;", (table,))
+        return conn.execute("SELECT value FROM ShardSequences WHERE name = ?;", (table,)).fetchone()["value"]
+
+    def query_snapshot(self, query: str, one: bool = False, args: tuple = (), shard: int = 0) -> Any:
+        """Queries the latest snapshot of the database and returns the result.
+
+        Use this for heavy analytical queries, so that they never hold read transactions on the live database.
+
+        params:
+            query: The SQL query to execute.
+            one: Whether to return a single row or a list of rows.
+            args: Additional arguments to pass to the query.
+            shard: The index of the shard whose snapshot to query.
+
+        returns: A single row, a list of rows or None.
+
+        """
+        with self.snapshot(shard) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, args)
+                return cursor.fetchone() if one else cursor.fetchall()
+            except sqlite3.Error as e:
+                print(f"Error: {e}")
+                return None
+            finally:
+                cursor.close()
+
+    def query_snapshots(
+        self, query: str, args: tuple = (), *, key: Optional[Callable[[sqlite3.Row], Any]] = None, reverse: bool = False
+    ) -> list[sqlite3.Row]:
+        """Queries the latest snapshot of every database shard and returns the combined rows.
+
+        The shards are backed up one after the other, so their snapshots are not taken at the same point in time. A
+        row moved between shards during a backup may be missing from, or appear twice in, the result.
+
+        params:
+            query: The SQL query to execute.
+            args: Additional arguments to pass to the query.
+            key (optional): Returns the sort key of a row. The rows of each shard must already be sorted by this key,
+                and are merged in order.
+            reverse: Whether the rows are sorted in descending order.
+
+        returns: A list of rows.
+
+        """
+        results = [self.query_snapshot(query, args=args, shard=shard) or [] for shard in range(self.shard_count)]
+        if key is None:
+            return list(chain.from_iterable(results))
+        return list(heapq.merge(*results, key=key, reverse=reverse))
+
+    @contextmanager
+    def snapshot(self, shard: int = 0) -> Iterator[sqlite3.Connection]:
+        """Provides a read-only connection to the latest snapshot of a database shard from the connection pool.
+
+        Pooled connections to a snapshot which has since been replaced by a newer backup are closed and reopened.
+        """
+        state = self._state
+        snapshot_path = _shard_path(state.snapshot_path, shard)
+        try:
+            generation = snapshot_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            raise RuntimeError("No database snapshot exists yet, take one with 'flask backup'") from None
+
+        conn = None
+        stale = []
+        with state.snapshot_pool_lock:
+            if state.snapshot_pool_pid != os.getpid():
+                # Connections must not be shared with a forked process
+                state.snapshot_pool, state.snapshot_pool_pid = {}, os.getpid()
+            pool = state.snapshot_pool.setdefault(shard, [])
+            while pool and conn is None:
+                pooled_generation, pooled = pool.pop()
+                if pooled_generation == generation:
+                    conn = pooled
+                else:
+                    stale.append(pooled)
+        for pooled in stale:
+            pooled.close()
+
+        if conn is None:
+            conn = sqlite3.connect(f"{snapshot_path.as_uri()}?mode=ro", uri=True, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            with state.snapshot_pool_lock:
+                pool = state.snapshot_pool.setdefault(shard, [])
+                if state.snapshot_pool_pid == os.getpid() and len(pool) < state.snapshot_pool_size:
+                    pool.append((generation, conn))
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def backup(self) -> Path:
+        """Takes an online snapshot of every database shard with the SQLite3 backup API.
+
+        The shards are in WAL mode, and each one is copied inside a single read transaction, so the copy sees a fixed
+        version of the shard while writers carry on, and SQLite never restarts it. The copy is made
+        `SQLITE3_BACKUP_PAGES` pages at a time, pausing `SQLITE3_BACKUP_SLEEP` seconds after each step to limit the
+        I/O it takes from requests. Each snapshot is replaced atomically once its copy is complete. The shards are
+        copied one after the other, so their snapshots are not taken at the same point in time.
+
+        returns: The path to the snapshot of the first shard.
+
+        """
+        state = self._state
+        pages = current_app.config["SQLITE3_BACKUP_PAGES"]
+        sleep = current_app.config["SQLITE3_BACKUP_SLEEP"]
+
+        def throttle(status: int, remaining: int, total: int) -> None:
+            if remaining:
+                time.sleep(sleep)
+
+        for shard in range(state.shard_count):
+            snapshot_path = _shard_path(state.snapshot_path, shard)
+            # Each backup gets its own temporary file, so concurrent backups do not write to the same file
+            fd, temporary_name = tempfile.mkstemp(
+                dir=snapshot_path.parent, prefix=f"{snapshot_path.name}.", suffix=".tmp"
+            )
+            os.close(fd)
+            source = sqlite3.connect(_shard_path(state.path, shard))
+            target = sqlite3.connect(temporary_name)
+            try:
+                # Hold a read transaction for the whole copy, so that it reads a single version of the shard
+                source.execute("BEGIN;")
+                source.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()
+                source.backup(target, pages=pages, progress=throttle)
+                # The snapshot is opened read-only, which a database in WAL mode does not allow without its -shm file
+                target.execute("PRAGMA journal_mode = DELETE;")
+            except sqlite3.Error:
+                target.close()
+                os.unlink(temporary_name)
+                raise
+            finally:
+                target.close()
+                source.close()
+            os.replace(temporary_name, snapshot_path)
+        return state.snapshot_path
 
     # TODO: Add more specific query methods to simplify code
 
     def _init_database(self, schema: PathLike | str) -> None:
-        """Initializes the database with the supplied schema if it does not exist yet."""
+        """Initializes the database with the supplied schema if it is not current yet.
+
+        The checksum of the schema is stored in the `user_version` pragma, so the schema is only executed when the
+        database is new or the schema file has changed. The schema recreates the tables of the first shard, so the
+        other shards and the shard directory are reset with it, as their rows refer to users which no longer exist.
+        """
         try:
-            with current_app.open_resource(str(schema), mode="r") as file:
-                self.connection.executescript(file.read())
-                self.connection.commit()
+            with current_app.open_resource(str(schema), mode="rb") as file:
+                script = file.read()
+            version = zlib.crc32(script) & 0x7FFFFFFF or 1
+            if self.connection.execute("PRAGMA user_version;").fetchone()[0] == version:
+                return
+            self.connection.executescript(script.decode("utf-8"))
+            self._reset_shards()
+            self.connection.execute(f"PRAGMA user_version = {version};")
+            self.connection.commit()
         except sqlite3.Error as e:
         # Handle database initialization errors
             print(f"init Eerror: {e}")
 
+    def _reset_shards(self) -> None:
+        """Drops the tables of the additional shards, and the tables used to track the shards.
+
+        The tables are recreated by `_init_shards`. The files of the shards beyond `SQLITE3_SHARDS` are removed.
+        """
+        state = self._state
+        self.connection.executescript("DROP TABLE IF EXISTS [ShardDirectory]; DROP TABLE IF EXISTS [ShardSequences];")
+        for shard in range(1, state.shard_count):
+            conn = sqlite3.connect(_shard_path(state.path, shard))
+            try:
+                tables = conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%';"
+                ).fetchall()
+                conn.executescript("".join(f"DROP TABLE IF EXISTS [{name}];" for name, in tables))
+            finally:
+                conn.close()
+        for shard in self.removed_shards():
+            shard_path = _shard_path(state.path, shard)
+            for suffix in ("", "-wal", "-shm"):
+                shard_path.with_name(f"{shard_path.name}{suffix}").unlink(missing_ok=True)
+
+    def _init_shards(self, shard_schema: Optional[PathLike | str]) -> None:
+        """Initializes the additional shards with the supplied schema, and the tables used to track the shards."""
+        state = self._state
+        for shard in range(state.shard_count):
+            conn = sqlite3.connect(_shard_path(state.path, shard))
+            try:
+                # Readers, such as the backup, then do not block writers
+                conn.execute("PRAGMA journal_mode = WAL;")
+                if shard == 0:
+                    conn.executescript(SHARD_DIRECTORY_SCHEMA)
+                elif shard_schema:
+                    with current_app.open_resource(str(shard_schema), mode="r") as file:
+                        conn.executescript(file.read())
+                conn.executescript(SHARD_SEQUENCES_SCHEMA)
+            finally:
+                conn.close()
+
+        for shard in self.removed_shards():
+            conn = sqlite3.connect(_shard_path(state.path, shard))
+            try:
+                rows = conn.execute("SELECT (SELECT COUNT(*) FROM Posts) + (SELECT COUNT(*) FROM Comments);").fetchone()
+            finally:
+                conn.close()
+            if rows[0]:
+                current_app.logger.warning(
+                    "Shard %d is beyond SQLITE3_SHARDS but still holds %d rows, which are not shown until they are "
+                    "moved with 'flask rebalance'",
+                    shard,
+                    rows[0],
+                )
+
+    @property
+    def _state(self) -> _SQLite3State:
+        """Returns the state of the extension for the current application."""
+        return cast(_SQLite3State, current_app.extensions["sqlite3_state"])
+
     def _close_connection(self, exception: Optional[BaseException] = None) -> None:
-        """Closes the connection to the database."""
+        """Closes the connections to the database."""
         conn = cast(sqlite3.Connection, getattr(g, "flask_sqlite3_connection", None))
         if conn is not None:
             conn.close()
+        for conn in getattr(g, "flask_sqlite3_shard_connections", {}).values():
+            conn.close()
+
+
+class _SQLite3State:
+    """Holds the state of the SQLite3 extension for one application."""
+
+    def __init__(self, *, path: Path, shard_count: int, snapshot_path: Path, snapshot_pool_size: int) -> None:
+        self.path = path
+        self.shard_count = shard_count
+        self.shard_local = threading.local()
+        self.shard_executor: Optional[ThreadPoolExecutor] = None
+        self.shard_executor_pid: Optional[int] = None
+        self.snapshot_path = snapshot_path
+        self.snapshot_pool_size = snapshot_pool_size
+        self.snapshot_pool: dict[int, list[tuple[int, sqlite3.Connection]]] = {}
+        self.snapshot_pool_pid = os.getpid()
+        self.snapshot_pool_lock = threading.Lock()
+
+
+def _shard_path(path: Path, shard: int) -> Path:
+    """Returns the path to a shard of a database file. The first shard is the file itself."""
+    return path if shard == 0 else path.with_name(f"{path.stem}.shard{shard}{path.suffix}")
+
+
+def _executor(state: _SQLite3State) -> ThreadPoolExecutor:
+    """Returns the thread pool used to query the shards in parallel, creating it after a fork."""
+    if state.shard_executor is None or state.shard_executor_pid != os.getpid():
+        state.shard_executor = ThreadPoolExecutor(state.shard_count, thread_name_prefix="sqlite3-shard")
+        state.shard_executor_pid = os.getpid()
+    return state.shard_executor
+
+
+def _query_in_thread(state: _SQLite3State, shard: int, query: str, one: bool, args: tuple) -> Any:
+    """Queries a shard from a thread of the thread pool, which keeps its own connection to each shard."""
+    connections = getattr(state.shard_local, "connections", None)
+    if connections is None or state.shard_local.pid != os.getpid():
+        connections = state.shard_local.connections = {}
+        state.shard_local.pid = os.getpid()
+    conn = connections.get(shard)
+    if conn is None:
+        conn = connections[shard] = sqlite3.connect(_shard_path(state.path, shard))
+        conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, args)
+        return cursor.fetchone() if one else cursor.fetchall()
+    except sqlite3.Error as e:
+        print(f"Error: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.rollback()
+
+
+@click.command("backup")
+@with_appcontext
+def backup_command() -> None:
+    """Takes an online snapshot of the database."""
+    path = current_app.extensions["sqlite3"].backup()
+    click.echo(f"Database snapshot written to {path}.")
@@ -0,0 +1,43 @@
+"""Provides the Flask extensions used by the Social Insecurity application.
+
+The extensions are created here without an application and bound to one by the
+application factory. This module is only imported from within the factory, so
+importing the app package stays cheap.
+
+Example:
+    from app.extensions import sqlite
+
+    user = sqlite.query("SELECT * FROM Users WHERE id = ?", one=True, args=(1,))
+"""
+
+from flask_bcrypt import Bcrypt
+from flask_bootstrap import Bootstrap
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from flask_wtf.csrf import CSRFProtect
+
+from app.assets import StaticAssets
+from app.compression import Compress
+from app.database import SQLite3
+from app.tasks import TaskQueue
+
+bootstrap = Bootstrap()
+
+# Compress responses, and serve precompressed static files
+compress = Compress()
+static_assets = StaticAssets()
+
+# Instantiate the sqlite database extension
+sqlite = SQLite3()
+
+# Run deferred work in the background, outside of the request
+tasks = TaskQueue()
+
+# Rate limit
+limiter = Limiter(get_remote_address, default_limits=["1000 per day", "500 per hour", "10 per minute"])
+
+# TODO: The passwords are stored in plaintext, this is not secure at all. I should probably use bcrypt or something
+bcrypt = Bcrypt()
+
+# TODO: The CSRF protection is not working, I should probably fix that
+csrf = CSRFProtect()
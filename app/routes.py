@@ -1,24 +1,26 @@
 """Provides all routes for the Social Insecurity application.
 
-This file contains the routes for the application. It is imported by the app package.
-It also contains the SQL queries used for communicating with the database.
+This file contains the routes for the application. It is imported by the application factory, which registers
+the routes with `init_app`.
+It also contains the SQL queries used for communicating with the database, except for those for posts and comments,
+which are stored in sharded databases and queried through the app.sharding module.
 """
 
 from pathlib import Path
 
 
-from flask import flash, redirect, render_template, send_from_directory, url_for, session
+from flask import Flask, current_app, flash, redirect, render_template, send_from_directory, url_for, session
 
-from app import app, sqlite, bcrypt, login_required, limiter
+from app import login_required
+from app.extensions import bcrypt, limiter, sqlite
 from app.forms import CommentsForm, FriendsForm, IndexForm, PostForm, ProfileForm
+from app.sharding import find_post_shard, get_comments, get_feed, get_post, insert_comment, insert_post
 import os
 import re
 import bleach
 from werkzeug.utils import secure_filename
 #from flask_login import login_user, login_required, current_user, logout_user
 
-@app.route("/", methods=["GET", "POST"])
-@app.route("/index", methods=["GET", "POST"])
 @limiter.limit("5 per minute")
 def index():
     ###IDEA USE parameterized queries to prevent SQL injection,
@@ -82,7 +84,6 @@ def index():
 
 
    
-@app.route("/stream/<string:username>", methods=["GET", "POST"])
 @limiter.limit("20 per minute")
 @login_required
 def stream(username: str):
@@ -103,29 +104,21 @@ def stream(username: str):
                 flash("File size exceeds allowed limit.", category="error")
                 return redirect(url_for("stream", username=username))
             filename = secure_filename(post_form.image.data.filename)
-            path = Path(app.instance_path) / app.config["UPLOADS_FOLDER_PATH"] / filename
+            path = Path(current_app.instance_path) / current_app.config["UPLOADS_FOLDER_PATH"] / filename
             post_form.image.data.save(path)
 
-        insert_post_query = """
-            INSERT INTO Posts (u_id, content, image, creation_time)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP);
-            """
-        args = (user["id"], post_form.content.data, post_form.image.data.filename)
-        sqlite.query(insert_post_query, args=args)
+        # Posts are stored in the shard of their author
+        insert_post(user["id"], post_form.content.data, post_form.image.data.filename)
         return redirect(url_for("stream", username=username))
    
-    get_posts_query = """
-        SELECT p.*, u.*, (SELECT COUNT(*) FROM Comments WHERE p_id = p.id) AS cc
-        FROM Posts AS p JOIN Users AS u ON u.id = p.u_id
-        WHERE p.u_id IN (
-            SELECT u_id FROM Friends WHERE f_id = ?
-            ) OR p.u_id IN (
-            SELECT f_id FROM Friends WHERE u_id = ?
-            ) OR p.u_id = ?
-            ORDER BY p.creation_time DESC;
+    get_friends_query = """
+        SELECT u_id FROM Friends WHERE f_id = ?
+        UNION
+        SELECT f_id FROM Friends WHERE u_id = ?;
         """
-    args = (user["id"], user["id"], user["id"])
-    posts = sqlite.query(get_posts_query, args=args)
+    friends = sqlite.query(get_friends_query, args=(user["id"], user["id"]))
+    # The posts of the user and their friends are read from all shards in parallel, and merged newest first
+    posts = get_feed([user["id"], *(friend["u_id"] for friend in friends)])
 
     cleanedPosts = []
     
@@ -138,7 +131,6 @@ def stream(username: str):
     return render_template("stream.html.j2", title="Stream", username=username, form=post_form, posts=posts)
 
 
-@app.route("/comments/<string:username>/<int:post_id>", methods=["GET", "POST"])
 @limiter.limit("10 per minute")
 @login_required
 def comments(username: str, post_id: int):
@@ -155,30 +147,16 @@ def comments(username: str, post_id: int):
         WHERE username = ?;
     """
     user = sqlite.query(get_user, one=True, args=(username,))
+    # Comments are stored in the shard of the post they belong to, so it is only looked up once
+    shard = find_post_shard(post_id)
 
-    if comments_form.is_submitted():
+    if comments_form.is_submitted() and shard is not None:
         # Sanitize user comment data using bleach
         user_comment = bleach.clean(comments_form.comment.data, tags=[], attributes={})
-        insert_comment = """
-            INSERT INTO Comments (p_id, u_id, comment, creation_time)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP);
-        """
-        sqlite.query(insert_comment, args=(post_id, user["id"], user_comment))
+        insert_comment(post_id, user["id"], user_comment, shard)
 
-    get_post = """
-        SELECT *
-        FROM Posts AS p JOIN Users AS u ON p.u_id = u.id
-        WHERE p.id = ?;
-    """
-    post = sqlite.query(get_post, one=True, args=(post_id,))
-    
-    get_comments = """
-        SELECT DISTINCT *
-        FROM Comments AS c JOIN Users AS u ON c.u_id = u.id
-        WHERE c.p_id = ?
-        ORDER BY c.creation_time DESC;
-    """
-    comments = sqlite.query(get_comments, args=(post_id,))
+    post = get_post(post_id, shard) if shard is not None else None
+    comments = get_comments(post_id, shard) if shard is not None else []
     
     # post = sqlite.query(get_post, one=True)
     # comments = sqlite.query(get_comments)
@@ -187,7 +165,6 @@ def comments(username: str, post_id: int):
     )
 
 
-@app.route("/friends/<string:username>", methods=["GET", "POST"])
 @login_required
 def friends(username: str):
     """Provides the friends page for the application.
@@ -246,7 +223,6 @@ def friends(username: str):
 
 
 
-@app.route("/profile/<string:username>", methods=["GET", "POST"])
 @login_required
 def profile(username: str):
     """Provides the profile page for the application.
@@ -300,16 +276,26 @@ def profile(username: str):
 
 
 
-@app.route("/uploads/<string:filename>")
 @login_required
 def uploads(filename):
     """Provides an endpoint for serving uploaded files."""
-    return send_from_directory(Path(app.instance_path) / app.config["UPLOADS_FOLDER_PATH"], filename)
+    return send_from_directory(Path(current_app.instance_path) / current_app.config["UPLOADS_FOLDER_PATH"], filename)
 
 
 
-@app.route("/logout")
 def logout():
     """Logs the user out and clears the session."""
     session.clear()  # Clear the user's session
-    return redirect(url_for("index"))  
+    return redirect(url_for("index"))
+
+
+def init_app(app: Flask) -> None:
+    """Registers all routes with the application."""
+    app.add_url_rule("/", view_func=index, methods=["GET", "POST"])
+    app.add_url_rule("/index", view_func=index, methods=["GET", "POST"])
+    app.add_url_rule("/stream/<string:username>", view_func=stream, methods=["GET", "POST"])
+    app.add_url_rule("/comments/<string:username>/<int:post_id>", view_func=comments, methods=["GET", "POST"])
+    app.add_url_rule("/friends/<string:username>", view_func=friends, methods=["GET", "POST"])
+    app.add_url_rule("/profile/<string:username>", view_func=profile, methods=["GET", "POST"])
+    app.add_url_rule("/uploads/<string:filename>", view_func=uploads)
+    app.add_url_rule("/logout", view_func=logout)
@@ -0,0 +1,29 @@
+-- ---
+-- Tables stored in the additional shards, see SQLITE3_SHARDS
+-- The first shard is the main database, whose tables are defined in schema.sql
+-- ---
+
+-- ---
+-- Table 'Posts'
+--
+-- ---
+CREATE TABLE IF NOT EXISTS [Posts](
+  id INTEGER PRIMARY KEY,
+  u_id INTEGER,
+  content INTEGER,
+  [image] VARCHAR,
+  [creation_time] DATETIME
+);
+
+-- ---
+-- Table 'Comments'
+--
+-- ---
+CREATE TABLE IF NOT EXISTS [Comments](
+  id INTEGER PRIMARY KEY,
+  p_id INTEGER,
+  u_id INTEGER,
+  comment VARCHAR,
+  [creation_time] DATETIME,
+  FOREIGN KEY (p_id) REFERENCES Posts(id)
+);
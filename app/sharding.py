@@ -0,0 +1,213 @@
+"""Provides the routing of posts and comments to the database shards for the Social Insecurity application.
+
+Posts are stored in the shard of their author, and comments are stored next to the post they belong to. Users and
+friends are only stored in the main database. This file contains the SQL queries used for posts and comments, and is
+imported by the routes.
+
+Example:
+    from app.sharding import get_feed, insert_post
+
+    post_id = insert_post(user["id"], "Hello", None)
+    posts = get_feed([user["id"]])
+"""
+
+from __future__ import annotations
+
+from typing import Any, Optional
+
+import click
+from flask.cli import with_appcontext
+
+from app.extensions import sqlite
+
+
+def insert_post(u_id: int, content: str, image: Optional[str]) -> int:
+    """Inserts a new post into the shard of its author and returns its id."""
+    shard = sqlite.shard_for(u_id)
+    with sqlite.shard_connection(shard) as conn:
+        post_id = sqlite.next_id(shard, "Posts")
+        conn.execute(
+            """
+            INSERT INTO Posts (id, u_id, content, image, creation_time)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP);
+            """,
+            (post_id, u_id, content, image),
+        )
+    return post_id
+
+
+def insert_comment(post_id: int, u_id: int, comment: str, shard: Optional[int] = None) -> Optional[int]:
+    """Inserts a new comment into the shard of the post it belongs to and returns its id.
+
+    The comment is only inserted if the post is still stored in the shard, as `move_user` may have moved it since the
+    shard was looked up. The shard is then looked up again, so the comment is not left behind in the old shard.
+
+    params:
+        post_id: The id of the post.
+        u_id: The id of the author of the comment.
+        comment: The text of the comment.
+        shard (optional): The shard of the post, as returned by `find_post_shard`. Is looked up if not given.
+
+    returns: The id of the comment, or None if the post does not exist.
+
+    """
+    while True:
+        if shard is None:
+            shard = find_post_shard(post_id)
+        if shard is None:
+            return None
+        with sqlite.shard_connection(shard) as conn:
+            comment_id = sqlite.next_id(shard, "Comments")
+            cursor = conn.execute(
+                """
+                INSERT INTO Comments (id, p_id, u_id, comment, creation_time)
+                SELECT ?, ?, ?, ?, CURRENT_TIMESTAMP
+                WHERE EXISTS (SELECT 1 FROM Posts WHERE id = ?);
+                """,
+                (comment_id, post_id, u_id, comment, post_id),
+            )
+        if cursor.rowcount > 0:
+            return comment_id
+        shard = None
+
+
+def get_feed(u_ids: list[int]) -> list[dict[str, Any]]:
+    """Returns the posts of the given authors from all shards, newest first, with their comment count.
+
+    A post is only returned once, even if an interrupted `move_user` left a copy of it in two shards.
+    """
+    placeholders = ", ".join("?" * len(u_ids))
+    get_posts = f"""
+        SELECT p.*, (SELECT COUNT(*) FROM Comments WHERE p_id = p.id) AS cc
+        FROM Posts AS p
+        WHERE p.u_id IN ({placeholders})
+        ORDER BY p.creation_time DESC;
+        """
+    posts = sqlite.query_shards(get_posts, args=tuple(u_ids), key=lambda post: post["creation_time"], reverse=True)
+    unique_posts: dict[int, Any] = {}
+    for post in posts:
+        unique_posts.setdefault(post["id"], post)
+    return _join_users(list(unique_posts.values()))
+
+
+def get_post(post_id: int, shard: Optional[int] = None) -> Optional[dict[str, Any]]:
+    """Returns a post from the given shard, or from any shard if none is given. Returns None if it does not exist."""
+    if shard is None:
+        posts = sqlite.query_shards("SELECT * FROM Posts WHERE id = ?;", args=(post_id,))
+    else:
+        posts = sqlite.query_shard(shard, "SELECT * FROM Posts WHERE id = ?;", args=(post_id,)) or []
+    return _join_users(posts[:1])[0] if posts else None
+
+
+def get_comments(post_id: int, shard: Optional[int] = None) -> list[dict[str, Any]]:
+    """Returns the comments of a post, newest first. The shard of the post is looked up if it is not given."""
+    if shard is None:
+        shard = find_post_shard(post_id)
+    if shard is None:
+        return []
+    get_comments = """
+        SELECT DISTINCT *
+        FROM Comments
+        WHERE p_id = ?
+        ORDER BY creation_time DESC;
+    """
+    return _join_users(sqlite.query_shard(shard, get_comments, args=(post_id,)) or [])
+
+
+def move_user(u_id: int, shard: int) -> int:
+    """Moves the posts of a user, and the comments on them, from all other shards to the given shard.
+
+    The posts are also moved out of the shards beyond `SQLITE3_SHARDS` left behind by reducing the number of shards.
+    The user is assigned to the shard first, unless it is already their shard, so new posts are written to it while
+    the existing ones are moved. Posts are read from every shard, so they stay visible during the move.
+
+    Each source shard is only cleared once its posts are committed to the target shard. If the move is interrupted in
+    between, the posts are left in both shards, and running it again removes the copies from the source shard.
+
+    returns: The number of posts moved.
+
+    """
+    if sqlite.shard_for(u_id) != shard:
+        sqlite.set_shard(u_id, shard)
+    target = sqlite.shard_connection(shard)
+    moved = 0
+    for source_shard in [*range(sqlite.shard_count), *sqlite.removed_shards()]:
+        if source_shard == shard:
+            continue
+        source = sqlite.shard_connection(source_shard)
+        source.execute("BEGIN IMMEDIATE;")
+        try:
+            posts = source.execute("SELECT * FROM Posts WHERE u_id = ?;", (u_id,)).fetchall()
+            comments = source.execute(
+                "SELECT * FROM Comments WHERE p_id IN (SELECT id FROM Posts WHERE u_id = ?);", (u_id,)
+            ).fetchall()
+            with target:
+                target.executemany(
+                    """
+                    INSERT OR IGNORE INTO Posts (id, u_id, content, image, creation_time)
+                    VALUES (:id, :u_id, :content, :image, :creation_time);
+                    """,
+                    posts,
+                )
+                target.executemany(
+                    """
+                    INSERT OR IGNORE INTO Comments (id, p_id, u_id, comment, creation_time)
+                    VALUES (:id, :p_id, :u_id, :comment, :creation_time);
+                    """,
+                    comments,
+                )
+            source.execute("DELETE FROM Comments WHERE p_id IN (SELECT id FROM Posts WHERE u_id = ?);", (u_id,))
+            source.execute("DELETE FROM Posts WHERE u_id = ?;", (u_id,))
+            source.commit()
+        except BaseException:
+            source.rollback()
+            raise
+        moved += len(posts)
+    return moved
+
+
+def find_post_shard(post_id: int) -> Optional[int]:
+    """Returns the shard a post is stored in, or None if it does not exist. Queries every shard."""
+    rows = sqlite.query_each_shard("SELECT id FROM Posts WHERE id = ?;", one=True, args=(post_id,))
+    return next((shard for shard, row in enumerate(rows) if row is not None), None)
+
+
+def _join_users(rows: list[Any]) -> list[dict[str, Any]]:
+    """Adds the columns of the author from the main database to each row. The columns of the row take precedence."""
+    if not rows:
+        return []
+    u_ids = list({row["u_id"] for row in rows})
+    placeholders = ", ".join("?" * len(u_ids))
+    users = sqlite.query(f"SELECT * FROM Users WHERE id IN ({placeholders});", args=tuple(u_ids)) or []
+    users_by_id = {user["id"]: dict(user) for user in users}
+    return [{**users_by_id.get(row["u_id"], {}), **dict(row)} for row in rows]
+
+
+@click.command("rebalance")
+@click.option("--user", "username", help="Only move this user.")
+@click.option("--shard", type=int, help="The shard to move the user to.")
+@with_appcontext
+def rebalance_command(username: Optional[str], shard: Optional[int]) -> None:
+    """Moves the posts of users to the shard they are assigned to, or moves a single user to a new shard.
+
+    Posts are also moved out of the shards left behind by reducing `SQLITE3_SHARDS`.
+    """
+    if (username is None) != (shard is None):
+        raise click.UsageError("--user and --shard must be given together.")
+
+    if username is not None:
+        user = sqlite.query("SELECT id FROM Users WHERE username = ?;", one=True, args=(username,))
+        if user is None:
+            raise click.BadParameter(f"User {username} does not exist.", param_hint="--user")
+        if not 0 <= shard < sqlite.shard_count:
+            raise click.BadParameter(f"Shard {shard} does not exist.", param_hint="--shard")
+        users = [(user["id"], shard)]
+    else:
+        users = [(user["id"], sqlite.shard_for(user["id"])) for user in sqlite.query("SELECT id FROM Users;") or []]
+
+    moved = sum(move_user(u_id, target) for u_id, target in users)
+    click.echo(f"Moved {moved} posts of {len(users)} users.")
+    for removed_shard in sqlite.removed_shards():
+        remaining = sqlite.query_shard(removed_shard, "SELECT COUNT(*) FROM Posts;", one=True)
+        if remaining and remaining[0]:
+            click.echo(f"Shard {removed_shard} is beyond SQLITE3_SHARDS but still holds {remaining[0]} posts.")
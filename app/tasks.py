@@ -0,0 +1,394 @@
+"""Provides a background task queue extension for Flask.
+
+This extension runs deferred work on a pool of worker threads, so that requests can return as soon as their primary
+row is committed. Tasks are stored in a separate SQLite3 database, so that they survive restarts.
+
+Example:
+    from flask import Flask
+    from app.tasks import TaskQueue
+
+    app = Flask(__name__)
+    tasks = TaskQueue(app)
+
+    @tasks.task
+    def notify(user_id: int) -> None:
+        ...
+
+    # Inside a request
+    tasks.enqueue(notify, 1, idempotency_key="notify-1")
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from os import PathLike, getpid
+from pathlib import Path
+from typing import Any, Callable, Optional, Union, cast
+
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS [Tasks] (
+  id INTEGER PRIMARY KEY,
+  name VARCHAR NOT NULL,
+  args VARCHAR NOT NULL,
+  idempotency_key VARCHAR UNIQUE,
+  status VARCHAR NOT NULL DEFAULT 'pending',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  run_at REAL NOT NULL,
+  last_error VARCHAR
+);
+
+CREATE INDEX IF NOT EXISTS [Tasks_status_run_at] ON [Tasks](status, run_at);
+"""
+
+
+class _TaskQueueState:
+    """Holds the state of the task queue for a single application."""
+
+    def __init__(self, app: Flask, path: Path) -> None:
+        self.app = app
+        self.path = path
+        self.schedules: dict[str, float] = {}
+        self.scheduled_slots: dict[str, int] = {}
+        self.local = threading.local()
+        self.condition = threading.Condition()
+        self.stopping = threading.Event()
+        self.workers: list[threading.Thread] = []
+        self.pid: Optional[int] = None
+
+
+class TaskQueue:
+    """Provides a background task queue extension for Flask.
+
+    Each task is a row in the `Tasks` table. A worker claims a task by leasing it for `TASKS_LEASE_SECONDS`, so a
+    task held by a worker that died with its process is picked up again once the lease expires. Failed tasks are
+    retried with exponential backoff, starting at `TASKS_RETRY_BACKOFF` seconds, until `TASKS_MAX_ATTEMPTS` is
+    reached. Tasks are run inside an application context.
+
+    The worker threads are started on the first request or enqueued task in each process, so the application can be
+    created and preloaded before worker processes are forked from it. Each application has its own task database,
+    schedules and workers, which are looked up through `current_app`. Registered tasks are shared between them.
+
+    Example:
+        from flask import Flask
+        from app.tasks import TaskQueue
+
+        app = Flask(__name__)
+        tasks = TaskQueue(app)
+
+        # Use the queue
+        # tasks.enqueue(notify, 1)
+        # tasks.metrics()
+    """
+
+    def __init__(self, app: Optional[Flask] = None, *, path: Optional[PathLike | str] = None) -> None:
+        """Initializes the extension.
+
+        params:
+            app: The Flask application to initialize the extension with.
+            path (optional): The path to the task database file. Is relative to the instance folder.
+
+        """
+        self._tasks: dict[str, Callable[..., Any]] = {}
+        if app is not None:
+            self.init_app(app, path=path)
+
+    def init_app(self, app: Flask, *, path: Optional[PathLike | str] = None) -> None:
+        """Initializes the extension.
+
+        params:
+            app: The Flask application to initialize the extension with.
+            path (optional): The path to the task database file. Is relative to the instance folder.
+
+        """
+        if "tasks" not in app.extensions:
+            app.extensions["tasks"] = self
+        else:
+            raise RuntimeError("Flask TaskQueue extension already initialized")
+
+        app.config.setdefault("TASKS_DATABASE_PATH", "tasks.db")
+        app.config.setdefault("TASKS_WORKERS", 2)
+        app.config.setdefault("TASKS_MAX_ATTEMPTS", 5)
+        app.config.setdefault("TASKS_RETRY_BACKOFF", 2.0)
+        app.config.setdefault("TASKS_LEASE_SECONDS", 300)
+        app.config.setdefault("TASKS_POLL_INTERVAL", 1.0)
+
+        state = app.extensions["tasks_state"] = _TaskQueueState(
+            app, Path(app.instance_path) / (path or app.config["TASKS_DATABASE_PATH"])
+        )
+        state.path.parent.mkdir(parents=True, exist_ok=True)
+        # The connection is closed again, so that no connection is inherited by forked worker processes
+        conn = self._connect(state)
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+        app.before_request(self._start_workers)
+        app.cli.add_command(task_queue_command)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Returns the connection to the task database of the current application for the current thread."""
+        return self._connection(self._state)
+
+    def task(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        """Registers a function as a task, so that it can be enqueued."""
+        self._tasks[_task_name(func)] = func
+        return func
+
+    def schedule(self, task: Union[Callable[..., Any], str], interval: float) -> None:
+        """Schedules a registered task to be run every interval seconds.
+
+        The task is enqueued once per interval, with an idempotency key for the interval, so it is only run once even
+        when several processes share the task database.
+
+        params:
+            task: The registered task, or its name.
+            interval: The number of seconds between each run.
+
+        """
+        name = task if isinstance(task, str) else _task_name(task)
+        if name not in self._tasks:
+            raise ValueError(f"Task {name} is not registered")
+        self._state.schedules[name] = interval
+
+    def enqueue(
+        self, task: Union[Callable[..., Any], str], *args: Any, idempotency_key: Optional[str] = None, **kwargs: Any
+    ) -> bool:
+        """Enqueues a task to be run in the background.
+
+        params:
+            task: The registered task, or its name.
+            args: The JSON serializable arguments to pass to the task.
+            idempotency_key (optional): A key identifying the task. A task is not enqueued again if its key exists.
+            kwargs: The JSON serializable keyword arguments to pass to the task.
+
+        returns: Whether the task was enqueued.
+
+        """
+        return self._enqueue(self._state, task, args, kwargs, idempotency_key)
+
+    def metrics(self) -> dict[str, Any]:
+        """Returns the number of tasks in each status, and the age in seconds of the oldest due task."""
+        metrics: dict[str, Any] = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        for row in self.connection.execute("SELECT status, COUNT(*) AS count FROM Tasks GROUP BY status;"):
+            metrics[row["status"]] = row["count"]
+        oldest = self.connection.execute(
+            "SELECT MIN(run_at) FROM Tasks WHERE status = 'pending' AND run_at <= ?;", (time.time(),)
+        ).fetchone()[0]
+        metrics["oldest_pending_age"] = time.time() - oldest if oldest is not None else 0.0
+        return metrics
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stops the worker threads of the current application in this process, after their current task."""
+        state = self._state
+        state.stopping.set()
+        with state.condition:
+            state.condition.notify_all()
+        for worker in state.workers:
+            worker.join(timeout)
+        state.workers = []
+        state.pid = None
+        state.stopping.clear()
+
+    @property
+    def _state(self) -> _TaskQueueState:
+        """Returns the state of the task queue for the current application."""
+        return cast(_TaskQueueState, current_app.extensions["tasks_state"])
+
+    def _connection(self, state: _TaskQueueState) -> sqlite3.Connection:
+        """Returns the connection to the task database of an application for the current thread."""
+        conn = getattr(state.local, "connection", None)
+        if conn is None or state.local.pid != getpid():
+            conn = state.local.connection = self._connect(state)
+            state.local.pid = getpid()
+        return conn
+
+    def _connect(self, state: _TaskQueueState) -> sqlite3.Connection:
+        """Opens a new connection to the task database of an application."""
+        conn = sqlite3.connect(state.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL;")
+        return conn
+
+    def _enqueue(
+        self,
+        state: _TaskQueueState,
+        task: Union[Callable[..., Any], str],
+        args: tuple[Any, ...],
+        kwargs: dict[str, Any],
+        idempotency_key: Optional[str],
+    ) -> bool:
+        """Enqueues a task in the task database of an application, and wakes up one of its workers."""
+        name = task if isinstance(task, str) else _task_name(task)
+        if name not in self._tasks:
+            raise ValueError(f"Task {name} is not registered")
+
+        cursor = self._connection(state).execute(
+            "INSERT OR IGNORE INTO Tasks (name, args, idempotency_key, run_at) VALUES (?, ?, ?, ?);",
+            (name, json.dumps([args, kwargs]), idempotency_key, time.time()),
+        )
+        self._start_workers(state)
+        with state.condition:
+            state.condition.notify()
+        return cursor.rowcount > 0
+
+    def _start_workers(self, state: Optional[_TaskQueueState] = None) -> None:
+        """Starts the worker threads of an application, if they have not been started in this process yet."""
+        state = state or self._state
+        if state.pid == getpid():
+            return
+        with state.condition:
+            if state.pid == getpid():
+                return
+            state.workers = [
+                threading.Thread(target=self._work, args=(state,), name=f"task-worker-{i}", daemon=True)
+                for i in range(state.app.config["TASKS_WORKERS"])
+            ]
+            for worker in state.workers:
+                worker.start()
+            state.pid = getpid()
+
+    def _work(self, state: _TaskQueueState) -> None:
+        """Runs due tasks until the queue is stopped.
+
+        Errors outside of a task, such as a locked or unavailable task database, are logged and the worker backs off
+        for `TASKS_POLL_INTERVAL` seconds, so that it keeps running once the error has cleared.
+        """
+        while not state.stopping.is_set():
+            try:
+                self._enqueue_scheduled(state)
+                task = self._claim(state)
+                if task is None:
+                    with state.condition:
+                        state.condition.wait(state.app.config["TASKS_POLL_INTERVAL"])
+                    continue
+                self._run(state, task)
+            except Exception:
+                state.app.logger.exception("Task worker failed, retrying")
+                state.stopping.wait(state.app.config["TASKS_POLL_INTERVAL"])
+
+    def _enqueue_scheduled(self, state: _TaskQueueState) -> None:
+        """Enqueues the scheduled tasks which are due in the current interval."""
+        now = time.time()
+        for name, interval in state.schedules.items():
+            slot = int(now // interval)
+            if state.scheduled_slots.get(name) != slot:
+                state.scheduled_slots[name] = slot
+                self._enqueue(state, name, (), {}, f"{name}@{slot}")
+
+    def _claim(self, state: _TaskQueueState) -> Optional[sqlite3.Row]:
+        """Leases the next due task, including tasks whose lease has expired.
+
+        Tasks whose lease expired on their last attempt, for example because their process died, are marked as failed
+        instead of being run again. The returned row is read before the claim, so its attempt is `attempts + 1`.
+        """
+        now = time.time()
+        max_attempts = state.app.config["TASKS_MAX_ATTEMPTS"]
+        conn = self._connection(state)
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            conn.execute(
+                """
+                UPDATE Tasks
+                SET status = 'failed', last_error = 'Lease expired'
+                WHERE status = 'running' AND run_at <= ? AND attempts >= ?;
+                """,
+                (now, max_attempts),
+            )
+            task = conn.execute(
+                """
+                SELECT *
+                FROM Tasks
+                WHERE status IN ('pending', 'running') AND run_at <= ? AND attempts < ?
+                ORDER BY run_at
+                LIMIT 1;
+                """,
+                (now, max_attempts),
+            ).fetchone()
+            if task is not None:
+                conn.execute(
+                    "UPDATE Tasks SET status = 'running', attempts = attempts + 1, run_at = ? WHERE id = ?;",
+                    (now + state.app.config["TASKS_LEASE_SECONDS"], task["id"]),
+                )
+            conn.execute("COMMIT;")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK;")
+            raise
+        return task
+
+    def _run(self, state: _TaskQueueState, task: sqlite3.Row) -> None:
+        """Runs a claimed task and records the outcome, scheduling a retry if it failed.
+
+        The lease is renewed while the task runs, so that it is not claimed by another worker. The outcome is only
+        recorded if the task was not claimed again in the meantime, for example after this process was suspended for
+        longer than the lease.
+        """
+        app = state.app
+        attempts = task["attempts"] + 1
+        finished = threading.Event()
+        renewer = threading.Thread(
+            target=self._renew_lease, args=(state, task["id"], attempts, finished), name="task-lease", daemon=True
+        )
+        renewer.start()
+        try:
+            args, kwargs = json.loads(task["args"])
+            with app.app_context():
+                self._tasks[task["name"]](*args, **kwargs)
+        except Exception as e:
+            app.logger.exception("Task %s failed on attempt %d", task["name"], attempts)
+            if attempts >= app.config["TASKS_MAX_ATTEMPTS"] or task["name"] not in self._tasks:
+                status, run_at = "failed", time.time()
+            else:
+                status, run_at = "pending", time.time() + app.config["TASKS_RETRY_BACKOFF"] * 2 ** (attempts - 1)
+            last_error: Optional[str] = repr(e)
+        else:
+            status, run_at, last_error = "done", time.time(), None
+        finally:
+            finished.set()
+            renewer.join()
+
+        cursor = self._connection(state).execute(
+            """
+            UPDATE Tasks SET status = ?, run_at = ?, last_error = COALESCE(?, last_error)
+            WHERE id = ? AND attempts = ? AND status = 'running';
+            """,
+            (status, run_at, last_error, task["id"], attempts),
+        )
+        if cursor.rowcount == 0:
+            app.logger.warning("Task %s lost its lease on attempt %d, its outcome is discarded", task["name"], attempts)
+
+    def _renew_lease(self, state: _TaskQueueState, task_id: int, attempts: int, finished: threading.Event) -> None:
+        """Extends the lease of a running task every third of `TASKS_LEASE_SECONDS`, until it has finished."""
+        lease_seconds = state.app.config["TASKS_LEASE_SECONDS"]
+        conn = self._connect(state)
+        try:
+            while not finished.wait(lease_seconds / 3):
+                conn.execute(
+                    "UPDATE Tasks SET run_at = ? WHERE id = ? AND attempts = ? AND status = 'running';",
+                    (time.time() + lease_seconds, task_id, attempts),
+                )
+        except sqlite3.Error:
+            state.app.logger.exception("Could not renew the lease of task %d", task_id)
+        finally:
+            conn.close()
+
+
+def _task_name(func: Callable[..., Any]) -> str:
+    """Returns the name a task is registered under."""
+    return f"{func.__module__}.{func.__qualname__}"
+
+
+@click.command("task-queue")
+@with_appcontext
+def task_queue_command() -> None:
+    """Shows the number of tasks in the background task queue."""
+    for key, value in current_app.extensions["tasks"].metrics().items():
+        click.echo(f"{key}: {value}")
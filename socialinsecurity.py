@@ -7,7 +7,12 @@ To start the application enter 'pdm run flask --debug run' in a terminal.
 As an alternative, this file can also be run directly with 'pdm run python socialinsecurity.py'.
 """
 
-from app import app
+from app import create_app, prewarm
+
+app = create_app()
+
+# Compile the templates up front, so that workers forked from a preloaded app serve their first request warm
+prewarm(app)
 
 if __name__ == "__main__":
     app.run(debug=True)
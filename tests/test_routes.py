@@ -1,27 +1,46 @@
 from __future__ import annotations
 
+import gc
+import gzip
+import sqlite3
+import threading
+import time
 from collections.abc import Iterator
+from pathlib import Path
 from typing import TYPE_CHECKING
 
 import pytest
+from flask import Flask, url_for
 
-from app import app
+from app import create_app, prewarm
+from app.assets import StaticAssets
+from app.sharding import find_post_shard, get_comments, get_feed, get_post, insert_comment, insert_post, move_user
 
 if TYPE_CHECKING:
-    from flask import Flask
     from flask.testing import FlaskClient
 
 
 @pytest.fixture(scope="session")
-def test_app() -> Iterator[Flask]:
-    app.config.update(
+def test_app(tmp_path_factory: pytest.TempPathFactory) -> Iterator[Flask]:
+    instance_path: Path = tmp_path_factory.mktemp("instance")
+    app = create_app(
         {
-            "SQLITE3_DATABASE": "file::memory:?cache=shared",
+            "SQLITE3_DATABASE_PATH": str(instance_path / "sqlite3.db"),
+            "SQLITE3_SNAPSHOT_PATH": str(instance_path / "snapshot.db"),
+            "SQLITE3_BACKUP_INTERVAL": 0,
+            "SQLITE3_SHARDS": 3,
+            "UPLOADS_FOLDER_PATH": str(instance_path / "uploads"),
+            "TEMPLATE_CACHE_FOLDER_PATH": str(instance_path / "template_cache"),
+            "STATIC_BUILD_FOLDER_PATH": str(instance_path / "static_build"),
+            "TASKS_DATABASE_PATH": str(instance_path / "tasks.db"),
+            "TASKS_RETRY_BACKOFF": 0,
             "TESTING": True,
             "WTF_CSRF_ENABLED": False,
         }
     )
     yield app
+    with app.app_context():
+        app.extensions["tasks"].stop(timeout=5)
 
 
 @pytest.fixture()
@@ -32,3 +51,373 @@ def client(test_app: Flask) -> FlaskClient:
 def test_request_index(client: FlaskClient):
     response = client.get("/")
     assert response.status_code == 200
+
+
+def test_schema_initialized_once(test_app: Flask):
+    sqlite = test_app.extensions["sqlite3"]
+    with test_app.app_context():
+        sqlite.query("INSERT INTO Users (username) VALUES (?);", args=("persisted",))
+        sqlite._init_database("schema.sql")
+        user = sqlite.query("SELECT * FROM Users WHERE username = ?;", one=True, args=("persisted",))
+    assert user is not None
+
+
+def test_precompile_templates(test_app: Flask):
+    result = test_app.test_cli_runner().invoke(args=["precompile-templates"])
+    assert result.exit_code == 0
+    assert "Precompiled" in result.output
+    assert any(Path(test_app.jinja_env.bytecode_cache.directory).iterdir())
+
+
+def test_boot_time(test_app: Flask):
+    prewarm(test_app)
+    result = test_app.test_cli_runner().invoke(args=["boot-time"])
+    assert result.exit_code == 0
+    assert "create_app: " in result.output
+    assert "prewarm: " in result.output
+
+
+def test_request_index_compressed(client: FlaskClient):
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert b"<html" in gzip.decompress(response.data)
+
+
+def test_build_static(test_app: Flask, client: FlaskClient):
+    result = test_app.test_cli_runner().invoke(args=["build-static"])
+    assert result.exit_code == 0
+
+    with test_app.test_request_context():
+        url = url_for("static", filename="css/general.css")
+    assert url != "/static/css/general.css"
+
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.cache_control.immutable
+    response.close()
+
+
+def test_build_static_without_compress(tmp_path: Path):
+    app = Flask("app", instance_path=str(tmp_path))
+    assets = StaticAssets(app)
+    with app.app_context():
+        manifest = assets.build()
+    assert (tmp_path / "static_build" / f"{manifest['css/general.css']}.gz").exists()
+
+
+def test_task_queue_retries(test_app: Flask):
+    tasks = test_app.extensions["tasks"]
+    calls = []
+
+    @tasks.task
+    def flaky(value: int) -> None:
+        calls.append(value)
+        if len(calls) < 2:
+            raise RuntimeError("Try again")
+
+    with test_app.app_context():
+        assert tasks.enqueue(flaky, 1, idempotency_key="flaky-1")
+        assert not tasks.enqueue(flaky, 1, idempotency_key="flaky-1")
+
+        deadline = time.monotonic() + 5
+        while tasks.metrics()["done"] < 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert calls == [1, 1]
+        assert tasks.metrics()["pending"] == 0
+
+
+def test_task_queue_survives_worker_errors(test_app: Flask, monkeypatch: pytest.MonkeyPatch):
+    tasks = test_app.extensions["tasks"]
+    calls = []
+    claim = tasks._claim
+    lock = threading.Lock()
+
+    def failing_claim(state):
+        with lock:
+            if not calls:
+                calls.append("failed")
+                raise sqlite3.OperationalError("database is locked")
+        return claim(state)
+
+    @tasks.task
+    def succeed() -> None:
+        calls.append("done")
+
+    monkeypatch.setitem(test_app.config, "TASKS_POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(tasks, "_claim", failing_claim)
+    with test_app.app_context():
+        tasks.stop(timeout=5)
+        assert tasks.enqueue(succeed, idempotency_key="succeed-1")
+
+        deadline = time.monotonic() + 5
+        while "done" not in calls and time.monotonic() < deadline:
+            time.sleep(0.05)
+    assert calls == ["failed", "done"]
+
+
+def test_task_queue_renews_lease(test_app: Flask, monkeypatch: pytest.MonkeyPatch):
+    tasks = test_app.extensions["tasks"]
+    calls = []
+
+    @tasks.task
+    def slow() -> None:
+        calls.append(time.monotonic())
+        time.sleep(0.5)
+
+    monkeypatch.setitem(test_app.config, "TASKS_LEASE_SECONDS", 0.15)
+    monkeypatch.setitem(test_app.config, "TASKS_POLL_INTERVAL", 0.05)
+    with test_app.app_context():
+        tasks.stop(timeout=5)
+        tasks.enqueue(slow, idempotency_key="slow-1")
+
+        get_status = "SELECT status FROM Tasks WHERE idempotency_key = 'slow-1';"
+        deadline = time.monotonic() + 5
+        while tasks.connection.execute(get_status).fetchone()["status"] != "done" and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert tasks.connection.execute(get_status).fetchone()["status"] == "done"
+    assert len(calls) == 1
+
+
+def test_task_queue_fails_expired_tasks(test_app: Flask):
+    tasks = test_app.extensions["tasks"]
+    with test_app.app_context():
+        tasks.connection.execute(
+            """
+            INSERT INTO Tasks (name, args, idempotency_key, status, attempts, run_at)
+            VALUES ('app.missing', '[[], {}]', 'expired-1', 'running', ?, ?);
+            """,
+            (test_app.config["TASKS_MAX_ATTEMPTS"], time.time() - 1),
+        )
+        assert tasks._claim(test_app.extensions["tasks_state"]) is None
+        task = tasks.connection.execute("SELECT * FROM Tasks WHERE idempotency_key = 'expired-1';").fetchone()
+    assert task["status"] == "failed"
+    assert task["attempts"] == test_app.config["TASKS_MAX_ATTEMPTS"]
+
+
+def test_query_snapshot(test_app: Flask):
+    sqlite = test_app.extensions["sqlite3"]
+    with test_app.app_context():
+        sqlite.query("INSERT INTO Users (username) VALUES (?);", args=("snapshotted",))
+        sqlite.backup()
+        sqlite.query("INSERT INTO Users (username) VALUES (?);", args=("live",))
+
+        get_user = "SELECT * FROM Users WHERE username = ?;"
+        assert sqlite.query_snapshot(get_user, one=True, args=("snapshotted",)) is not None
+        assert sqlite.query_snapshot(get_user, one=True, args=("live",)) is None
+        assert sqlite.query_snapshot("INSERT INTO Users (username) VALUES ('readonly');") is None
+
+
+def test_backup_pauses_between_steps(test_app: Flask, monkeypatch: pytest.MonkeyPatch):
+    sqlite = test_app.extensions["sqlite3"]
+    sleeps = []
+    monkeypatch.setitem(test_app.config, "SQLITE3_BACKUP_PAGES", 1)
+    monkeypatch.setitem(test_app.config, "SQLITE3_BACKUP_SLEEP", 0.01)
+    monkeypatch.setattr("app.database.time.sleep", sleeps.append)
+    with test_app.app_context():
+        page_counts = [
+            sqlite.query_shard(shard, "PRAGMA page_count;", one=True)[0] for shard in range(sqlite.shard_count)
+        ]
+        sqlite.backup()
+    assert len(sleeps) >= sum(page_count - 1 for page_count in page_counts)
+    assert set(sleeps) == {0.01}
+
+
+def test_backup_while_writing(test_app: Flask, monkeypatch: pytest.MonkeyPatch):
+    sqlite = test_app.extensions["sqlite3"]
+    database_path = Path(test_app.instance_path) / test_app.config["SQLITE3_DATABASE_PATH"]
+    writes = []
+
+    def write_during_backup(seconds: float) -> None:
+        with sqlite3.connect(database_path, timeout=0) as conn:
+            conn.execute("INSERT INTO Users (username) VALUES ('during-backup');")
+        writes.append(seconds)
+
+    monkeypatch.setitem(test_app.config, "SQLITE3_BACKUP_PAGES", 1)
+    monkeypatch.setattr("app.database.time.sleep", write_during_backup)
+    with test_app.app_context():
+        sqlite.query("INSERT INTO Users (username) VALUES ('before-backup');")
+        sqlite.backup()
+
+        assert len(writes) > 1
+        get_user = "SELECT * FROM Users WHERE username = ?;"
+        assert sqlite.query_snapshot(get_user, one=True, args=("before-backup",)) is not None
+        assert sqlite.query_snapshot(get_user, one=True, args=("during-backup",)) is None
+    assert not list(Path(test_app.config["SQLITE3_SNAPSHOT_PATH"]).parent.glob("*.tmp"))
+
+
+def test_sharded_posts(test_app: Flask, client: FlaskClient):
+    sqlite = test_app.extensions["sqlite3"]
+    with test_app.app_context():
+        for username in ("alice", "bob"):
+            sqlite.query("INSERT INTO Users (username) VALUES (?);", args=(username,))
+        alice, bob = (
+            sqlite.query("SELECT id FROM Users WHERE username = ?;", one=True, args=(username,))["id"]
+            for username in ("alice", "bob")
+        )
+        sqlite.query("INSERT INTO Friends (u_id, f_id) VALUES (?, ?);", args=(alice, bob))
+        post_ids = [insert_post(alice, "Hello from alice", None), insert_post(bob, "Hello from bob", None)]
+        assert len({sqlite.shard_for(alice), sqlite.shard_for(bob)}) == 2
+        insert_comment(post_ids[0], bob, "Hello alice")
+
+        feed = get_feed([alice, bob])
+        assert {post["id"] for post in feed} == set(post_ids)
+        creation_times = [post["creation_time"] for post in feed]
+        assert creation_times == sorted(creation_times, reverse=True)
+
+        old_shard, target = sqlite.shard_for(alice), sqlite.shard_for(bob)
+        assert move_user(alice, target) == 1
+        assert sqlite.shard_for(alice) == target
+        assert get_post(post_ids[0])["username"] == "alice"
+        assert [comment["comment"] for comment in get_comments(post_ids[0])] == ["Hello alice"]
+        assert find_post_shard(post_ids[0]) == target
+        assert get_post(post_ids[0], target)["id"] == post_ids[0]
+
+        # A comment written to the shard the post was moved away from is inserted into its new shard
+        comment_id = insert_comment(post_ids[0], bob, "Hello again alice", old_shard)
+        assert comment_id is not None
+        assert sqlite.query_shard(old_shard, "SELECT * FROM Comments WHERE id = ?;", args=(comment_id,)) == []
+        assert len(get_comments(post_ids[0], target)) == 2
+
+        # A post left in its old shard by an interrupted move is only shown once
+        post = sqlite.query_shard(target, "SELECT * FROM Posts WHERE id = ?;", one=True, args=(post_ids[1],))
+        sqlite.query_shard(old_shard, "INSERT INTO Posts VALUES (?, ?, ?, ?, ?);", args=tuple(post))
+        assert [post["id"] for post in get_feed([alice, bob])].count(post_ids[1]) == 1
+        assert insert_post(alice, "Hello again", None) not in post_ids
+
+        sqlite.backup()
+        assert set(post_ids) <= {post["id"] for post in sqlite.query_snapshots("SELECT id FROM Posts;")}
+
+    with client.session_transaction() as session:
+        session["username"] = "alice"
+    response = client.get("/stream/alice")
+    assert response.status_code == 200
+    assert b"Hello from bob" in response.data
+
+    response = client.post(f"/comments/alice/{post_ids[1]}", data={"comment": "Hello bob"})
+    assert response.status_code == 200
+    assert b"Hello bob" in response.data
+
+
+def test_applications_keep_separate_state(test_app: Flask, tmp_path: Path):
+    other_app = create_app(
+        {
+            "SQLITE3_DATABASE_PATH": str(tmp_path / "sqlite3.db"),
+            "SQLITE3_SNAPSHOT_PATH": str(tmp_path / "snapshot.db"),
+            "SQLITE3_BACKUP_INTERVAL": 0,
+            "UPLOADS_FOLDER_PATH": str(tmp_path / "uploads"),
+            "TEMPLATE_CACHE_FOLDER_PATH": str(tmp_path / "template_cache"),
+            "STATIC_BUILD_FOLDER_PATH": str(tmp_path / "static_build"),
+            "TASKS_DATABASE_PATH": str(tmp_path / "tasks.db"),
+            "TESTING": True,
+        }
+    )
+    sqlite = test_app.extensions["sqlite3"]
+    assert other_app.extensions["sqlite3"] is sqlite
+
+    with other_app.app_context():
+        sqlite.query("INSERT INTO Users (username) VALUES (?);", args=("other",))
+        assert sqlite.shard_count == 1
+        assert other_app.extensions["tasks"].metrics()["done"] == 0
+    with test_app.app_context():
+        assert sqlite.query("SELECT * FROM Users WHERE username = ?;", one=True, args=("other",)) is None
+        assert sqlite.shard_count == 3
+
+
+def test_rebalance_after_removing_shards(tmp_path: Path):
+    config = {
+        "SQLITE3_DATABASE_PATH": str(tmp_path / "sqlite3.db"),
+        "SQLITE3_SNAPSHOT_PATH": str(tmp_path / "snapshot.db"),
+        "SQLITE3_BACKUP_INTERVAL": 0,
+        "SQLITE3_SHARDS": 3,
+        "UPLOADS_FOLDER_PATH": str(tmp_path / "uploads"),
+        "TEMPLATE_CACHE_FOLDER_PATH": str(tmp_path / "template_cache"),
+        "STATIC_BUILD_FOLDER_PATH": str(tmp_path / "static_build"),
+        "TASKS_DATABASE_PATH": str(tmp_path / "tasks.db"),
+        "TESTING": True,
+    }
+    app = create_app(config)
+    sqlite = app.extensions["sqlite3"]
+    with app.app_context():
+        u_ids = []
+        for shard in range(3):
+            sqlite.query("INSERT INTO Users (username) VALUES (?);", args=(f"user{shard}",))
+            u_ids.append(sqlite.query("SELECT MAX(id) FROM Users;", one=True)[0])
+            sqlite.set_shard(u_ids[-1], shard)
+            insert_comment(insert_post(u_ids[-1], f"Hello from shard {shard}", None), u_ids[-1], "Hello")
+
+    app = create_app({**config, "SQLITE3_SHARDS": 2})
+    sqlite = app.extensions["sqlite3"]
+    with app.app_context():
+        assert sqlite.removed_shards() == [2]
+        assert len(get_feed(u_ids)) == 2
+
+    result = app.test_cli_runner().invoke(args=["rebalance"])
+    assert result.exit_code == 0
+    assert "Moved 1 posts of 3 users." in result.output
+    with app.app_context():
+        feed = get_feed(u_ids)
+        assert len(feed) == 3
+        assert all(post["cc"] == 1 for post in feed)
+        assert sqlite.query_shard(2, "SELECT COUNT(*) FROM Posts;", one=True)[0] == 0
+
+
+def test_no_connection_left_open_after_create_app(tmp_path: Path):
+    def open_connections() -> set[int]:
+        gc.collect()
+        connections = set()
+        for obj in gc.get_objects():
+            if isinstance(obj, sqlite3.Connection):
+                try:
+                    obj.total_changes
+                except sqlite3.ProgrammingError:
+                    continue
+                connections.add(id(obj))
+        return connections
+
+    before = open_connections()
+    app = create_app(
+        {
+            "SQLITE3_DATABASE_PATH": str(tmp_path / "sqlite3.db"),
+            "SQLITE3_SNAPSHOT_PATH": str(tmp_path / "snapshot.db"),
+            "SQLITE3_SHARDS": 2,
+            "UPLOADS_FOLDER_PATH": str(tmp_path / "uploads"),
+            "TEMPLATE_CACHE_FOLDER_PATH": str(tmp_path / "template_cache"),
+            "STATIC_BUILD_FOLDER_PATH": str(tmp_path / "static_build"),
+            "TASKS_DATABASE_PATH": str(tmp_path / "tasks.db"),
+            "TESTING": True,
+        }
+    )
+    prewarm(app)
+    assert open_connections() - before == set()
+
+
+def test_schema_change_resets_every_shard(tmp_path: Path):
+    config = {
+        "SQLITE3_DATABASE_PATH": str(tmp_path / "sqlite3.db"),
+        "SQLITE3_SNAPSHOT_PATH": str(tmp_path / "snapshot.db"),
+        "SQLITE3_BACKUP_INTERVAL": 0,
+        "SQLITE3_SHARDS": 2,
+        "UPLOADS_FOLDER_PATH": str(tmp_path / "uploads"),
+        "TEMPLATE_CACHE_FOLDER_PATH": str(tmp_path / "template_cache"),
+        "STATIC_BUILD_FOLDER_PATH": str(tmp_path / "static_build"),
+        "TASKS_DATABASE_PATH": str(tmp_path / "tasks.db"),
+        "TESTING": True,
+    }
+    app = create_app(config)
+    sqlite = app.extensions["sqlite3"]
+    with app.app_context():
+        sqlite.query("INSERT INTO Users (username) VALUES ('alice');")
+        alice = sqlite.query("SELECT MAX(id) FROM Users;", one=True)[0]
+        sqlite.set_shard(alice, 1)
+        insert_post(alice, "Hello from alice", None)
+        # Pretend that the schema file has changed since the database was created
+        sqlite.query("PRAGMA user_version = 1;")
+
+    app = create_app(config)
+    with app.app_context():
+        assert sqlite.query("SELECT COUNT(*) FROM Users;", one=True)[0] == 0
+        assert sqlite.query("SELECT COUNT(*) FROM ShardDirectory;", one=True)[0] == 0
+        assert sqlite.query_shard(1, "SELECT COUNT(*) FROM Posts;", one=True)[0] == 0
+        assert get_feed([alice]) == []